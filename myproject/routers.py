@@ -0,0 +1,25 @@
+from django.conf import settings
+
+
+def replica_alias():
+    """Alias catalogue reads should use: the read replica when configured."""
+    return 'replica' if 'replica' in settings.DATABASES else 'default'
+
+
+class ReplicaRouter:
+    """Keep writes, reads and migrations on the primary by default.
+
+    Cart and expiry checks must see the latest writes, so only the catalogue
+    views opt in to the replica through ``replica_alias()``; the scraper pins
+    itself to the ``scraper`` alias explicitly.
+    """
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every alias points at the same data, so cross-alias relations are fine.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
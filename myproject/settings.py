@@ -54,17 +54,45 @@ TEMPLATES = [
 WSGI_APPLICATION = 'myproject.wsgi.application'
 
 
-DATABASES = {
-    'default': {
+def database(prefix='DB', pool_max_size=4, **extra):
+    config = {
         'ENGINE': 'django.db.backends.postgresql',
-        'NAME': os.getenv('DB_NAME'),
-        'USER': os.getenv('DB_USER'),
-        'PASSWORD': os.getenv('DB_PASSWORD'),
-        'HOST': os.getenv('DB_HOST'),
-        'PORT': os.getenv('DB_PORT'),
+        'NAME': os.getenv(f'{prefix}_NAME', os.getenv('DB_NAME')),
+        'USER': os.getenv(f'{prefix}_USER', os.getenv('DB_USER')),
+        'PASSWORD': os.getenv(f'{prefix}_PASSWORD', os.getenv('DB_PASSWORD')),
+        'HOST': os.getenv(f'{prefix}_HOST', os.getenv('DB_HOST')),
+        'PORT': os.getenv(f'{prefix}_PORT', os.getenv('DB_PORT')),
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
+        **extra,
     }
+    if os.getenv('DB_POOL') == 'True':
+        # psycopg's pool owns connection lifetime; Django rejects CONN_MAX_AGE alongside it.
+        config['CONN_MAX_AGE'] = 0
+        config['OPTIONS'] = {
+            'pool': {
+                'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '1')),
+                'max_size': pool_max_size,
+                'timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+            },
+        }
+    return config
+
+
+DATABASES = {
+    'default': database(pool_max_size=int(os.getenv('DB_POOL_MAX_SIZE', '4'))),
+    # Same primary, separate connections sized for the scraper's concurrent writes.
+    'scraper': database(
+        pool_max_size=int(os.getenv('DB_SCRAPER_POOL_MAX_SIZE', '10')),
+        TEST={'MIRROR': 'default'},
+    ),
 }
 
+if os.getenv('DB_REPLICA_HOST'):
+    DATABASES['replica'] = database('DB_REPLICA', TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['myproject.routers.ReplicaRouter']
+
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -107,4 +135,7 @@ REST_FRAMEWORK = {
         'user': '1000/day',
         'user_login': '5/minute',
     }
-}
\ No newline at end of file
+}
+
+# Overrides for shop.fetch.FetchPolicy (timeouts, retries, circuit breaker).
+SCRAPER_FETCH_POLICY = {}
@@ -0,0 +1,43 @@
+HISTOGRAM_BUCKETS = 10
+
+
+def parse_price(price):
+    # Prices are scraped as display strings ("250,000,000"); ads without a
+    # number (e.g. negotiable) don't count towards the statistics.
+    digits = ''.join(ch for ch in str(price) if ch.isdigit())
+    return int(digits) if digits else None
+
+
+def percentile(sorted_values, fraction):
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return round(sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower))
+
+
+def histogram(sorted_values, buckets=HISTOGRAM_BUCKETS):
+    low, high = sorted_values[0], sorted_values[-1]
+    width = (high - low) / buckets or 1
+    counts = [0] * buckets
+    for value in sorted_values:
+        counts[min(int((value - low) / width), buckets - 1)] += 1
+    return [
+        {'min': round(low + i * width), 'max': round(low + (i + 1) * width), 'count': count}
+        for i, count in enumerate(counts)
+    ]
+
+
+def summarize_prices(prices):
+    """Return count, percentiles and histogram buckets for a list of prices, or None."""
+    values = sorted(value for value in map(parse_price, prices) if value is not None)
+    if not values:
+        return None
+    return {
+        'count': len(values),
+        'min_price': values[0],
+        'p25_price': percentile(values, 0.25),
+        'median_price': percentile(values, 0.5),
+        'p75_price': percentile(values, 0.75),
+        'max_price': values[-1],
+        'histogram': histogram(values),
+    }
@@ -0,0 +1,158 @@
+import math
+import random
+import re
+import struct
+from array import array
+from hashlib import blake2b
+from .analytics import parse_price
+
+# 32 permutations split into 8 bands of 4 rows puts the LSH threshold
+# around a 0.6 Jaccard similarity, just below SIMILARITY_THRESHOLD.
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+SIMILARITY_THRESHOLD = 0.7
+# Reposts often come with a price cut, so prices only need to be this close.
+PRICE_TOLERANCE = 0.15
+
+# Seeded (a * x + b) mod p hash family, one function per permutation.
+_PRIME = (1 << 61) - 1
+_PERMUTATIONS = [
+    (rng.randrange(1, _PRIME), rng.randrange(_PRIME))
+    for rng in map(random.Random, range(NUM_PERM))
+]
+_NON_WORD = re.compile(r'[\W_]+')
+_NUMBER = re.compile(r'\d+')
+# Band index plus its rows, packed with a fixed byte order so keys persist.
+_BAND_ROWS = struct.Struct(f'<{ROWS + 1}q')
+_BAND_WIDTH = -math.log(1 - PRICE_TOLERANCE)
+
+
+def normalize_title(title):
+    return _NON_WORD.sub(' ', title.lower()).strip()
+
+
+def title_numbers(title):
+    # Model, year and trim numbers differ by a single trigram or two, which
+    # similarity alone tolerates; they have to match exactly.
+    return frozenset(int(number) for number in _NUMBER.findall(normalize_title(title)))
+
+
+def shingles(title, k=SHINGLE_SIZE):
+    text = normalize_title(title)
+    if len(text) <= k:
+        return {text}
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+def stable_hash(data):
+    # Built-in hash() of a str changes with PYTHONHASHSEED, i.e. per process,
+    # which would regroup listings differently on every crawl.
+    return int.from_bytes(blake2b(data.encode(), digest_size=8).digest(), 'big', signed=True)
+
+
+def minhash(title):
+    hashes = [stable_hash(s) & _PRIME for s in shingles(title)]
+    return array('q', [min([(a * h + b) % _PRIME for h in hashes]) for a, b in _PERMUTATIONS])
+
+
+def similarity(sig_a, sig_b):
+    return sum(a == b for a, b in zip(sig_a, sig_b)) / NUM_PERM
+
+
+def price_band(price):
+    # Log-scale bands as wide as the largest ratio prices_close accepts
+    # (1 / (1 - PRICE_TOLERANCE)), so matching prices are at most one band apart.
+    if not price:
+        return None
+    return int(math.log(price) / _BAND_WIDTH)
+
+
+def prices_close(a, b):
+    if not a or not b:
+        return not a and not b
+    return abs(a - b) <= PRICE_TOLERANCE * max(a, b)
+
+
+def fingerprint(title, price):
+    return minhash(title), title_numbers(title), parse_price(price)
+
+
+def band_keys(signature, numbers, band):
+    # Numbers have to match exactly anyway, so scoping buckets by them keeps
+    # common prefixes ("pride 131 se") from piling into a few huge buckets.
+    scope = f"{band}:{','.join(map(str, sorted(numbers)))}:".encode()
+    return [
+        int.from_bytes(
+            blake2b(scope + _BAND_ROWS.pack(i, *signature[i * ROWS:(i + 1) * ROWS]), digest_size=8).digest(),
+            'big', signed=True,
+        )
+        for i in range(BANDS)
+    ]
+
+
+def index_keys(fp):
+    signature, numbers, price = fp
+    return band_keys(signature, numbers, price_band(price))
+
+
+def lookup_keys(fp):
+    signature, numbers, price = fp
+    band = price_band(price)
+    bands = [None] if band is None else [band - 1, band, band + 1]
+    return [key for b in bands for key in band_keys(signature, numbers, b)]
+
+
+class LSHIndex:
+    """Banded MinHash index over canonical listings.
+
+    ``add`` returns the band keys it stored so callers can persist them and
+    ``load`` them back later; a lookup only touches ``3 * BANDS`` buckets
+    however large the catalogue is.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._fingerprints = {}
+
+    def load(self, band_key, key, fp):
+        self._fingerprints[key] = fp
+        self._buckets.setdefault(band_key, set()).add(key)
+
+    def add(self, key, fp):
+        keys = index_keys(fp)
+        for band_key in keys:
+            self.load(band_key, key, fp)
+        return keys
+
+    def match(self, fp):
+        """Return the lowest canonical key ``fp`` duplicates, or None."""
+        signature, numbers, price = fp
+        matches = set()
+        for band_key in lookup_keys(fp):
+            for other in self._buckets.get(band_key, ()):
+                other_signature, other_numbers, other_price = self._fingerprints[other]
+                if (other not in matches and numbers == other_numbers and prices_close(price, other_price)
+                        and similarity(signature, other_signature) >= SIMILARITY_THRESHOLD):
+                    matches.add(other)
+        return min(matches, default=None)
+
+
+def group_duplicates(listings):
+    """Map each listing id to the id of its canonical listing.
+
+    ``listings`` is an iterable of ``(id, title, price)``. A listing is a
+    duplicate of an earlier one when their titles are similar, carry the
+    same numbers and ask prices within PRICE_TOLERANCE of each other.
+    """
+    index = LSHIndex()
+    groups = {}
+    for key, title, price in sorted(listings, key=lambda listing: listing[0]):
+        fp = fingerprint(title, price)
+        canonical = index.match(fp)
+        if canonical is None:
+            index.add(key, fp)
+            canonical = key
+        groups[key] = canonical
+    return groups
@@ -0,0 +1,82 @@
+import asyncio
+import random
+import time
+import aiohttp
+
+# Statuses worth retrying: the server is overloaded or asking us to back off.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class UnexpectedPageError(Exception):
+    """The page came back but holds no listing data (captcha, WAF or error page)."""
+
+
+class CircuitOpenError(Exception):
+    """The host's circuit breaker is open, so the request wasn't sent."""
+
+
+class CircuitBreaker:
+    """Stop requests to a host after too many consecutive failures.
+
+    While the breaker is open, requests fail fast with CircuitOpenError. Only
+    one probe request waits out the cooldown; whether it succeeds decides if
+    the breaker closes or opens again.
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = {}
+        self._open_until = {}
+        self._probing = set()
+
+    def is_open(self, host):
+        return host in self._open_until
+
+    async def wait(self, host):
+        if host not in self._open_until:
+            return
+        if host in self._probing:
+            raise CircuitOpenError(f"Circuit open for {host}")
+        self._probing.add(host)
+        delay = self._open_until[host] - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record_success(self, host):
+        self._failures.pop(host, None)
+        self._open_until.pop(host, None)
+        self._probing.discard(host)
+
+    def record_failure(self, host):
+        self._failures[host] = self._failures.get(host, 0) + 1
+        # A failed probe opens the breaker again straight away.
+        if self._failures[host] >= self.threshold or host in self._probing:
+            self._failures[host] = 0
+            self._open_until[host] = time.monotonic() + self.cooldown
+        self._probing.discard(host)
+
+
+class FetchPolicy:
+    """Timeouts, retry schedule and circuit breaker shared by one crawl.
+
+    Keyword arguments can be overridden with ``settings.SCRAPER_FETCH_POLICY``.
+    """
+
+    def __init__(self, total=30, connect=5, read=15, retries=3, backoff=0.5, max_backoff=10,
+                 breaker_threshold=5, breaker_cooldown=30):
+        self.timeout = aiohttp.ClientTimeout(total=total, connect=connect, sock_read=read)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+
+    def delay(self, attempt):
+        # Full jitter keeps concurrent pages from retrying in lockstep.
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def is_transient(exc):
+        if isinstance(exc, aiohttp.ClientResponseError):
+            return exc.status in RETRY_STATUSES
+        return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
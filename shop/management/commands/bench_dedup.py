@@ -0,0 +1,44 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from shop.dedup import group_duplicates
+
+MODELS = ['Pride 131', 'Pride 111', 'Peugeot 206', 'Peugeot 405', 'Samand LX', 'Tiba 2', 'Dena Plus', 'Quick R']
+TRIMS = ['SE', 'SX', 'GLX', 'Tip 2', 'Tip 5', 'EF7', 'Turbo', '']
+SUFFIXES = ['', ' - urgent', ' full option', ' like new', '!!', ' (clean)']
+
+
+def synthetic_listings(count, repost_rate, seed=0):
+    rng = random.Random(seed)
+    listings = []
+    for key in range(1, count + 1):
+        if listings and rng.random() < repost_rate:
+            # Repost an earlier ad with a slightly different title.
+            _, title, price = listings[rng.randrange(len(listings))]
+            title = title + rng.choice(SUFFIXES)
+        else:
+            title = f"{rng.choice(MODELS)} {rng.choice(TRIMS)} {rng.randint(1385, 1403)} {rng.randint(0, 300_000)}km".replace('  ', ' ')
+            price = str(rng.randrange(1_000, 20_000) * 100_000)
+        listings.append((key, title, price))
+    return listings
+
+
+class Command(BaseCommand):
+    help = 'Benchmark near-duplicate grouping on synthetic listings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--listings', type=int, default=1_000_000)
+        parser.add_argument('--repost-rate', type=float, default=0.1)
+
+    def handle(self, *args, **options):
+        listings = synthetic_listings(options['listings'], options['repost_rate'])
+
+        started = time.perf_counter()
+        groups = group_duplicates(listings)
+        elapsed = time.perf_counter() - started
+
+        duplicates = sum(1 for key, canonical in groups.items() if key != canonical)
+        self.stdout.write(
+            f"{len(listings)} listings in {elapsed:.1f}s "
+            f"({len(listings) / elapsed:,.0f} listings/s), {duplicates} grouped as duplicates"
+        )
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0003_car_alter_cartitem_product_delete_cars'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='car',
+            name='last_seen_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='car',
+            name='is_active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name='car',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['id'], name='cars_active_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0004_car_last_seen_at_car_is_active'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='car',
+            name='canonical',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='shop.car'),
+        ),
+        migrations.RemoveIndex(
+            model_name='car',
+            name='cars_active_idx',
+        ),
+        migrations.AddIndex(
+            model_name='car',
+            index=models.Index(condition=models.Q(('canonical__isnull', True), ('is_active', True)), fields=['id'], name='cars_listed_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_car_canonical'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='car',
+            name='vehicle',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.CreateModel(
+            name='PriceSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vehicle', models.CharField(max_length=100, unique=True)),
+                ('count', models.PositiveIntegerField()),
+                ('min_price', models.BigIntegerField()),
+                ('p25_price', models.BigIntegerField()),
+                ('median_price', models.BigIntegerField()),
+                ('p75_price', models.BigIntegerField()),
+                ('max_price', models.BigIntegerField()),
+                ('histogram', models.JSONField(default=list)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0006_car_vehicle_pricesummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CarBand',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.BigIntegerField(db_index=True)),
+                ('car', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bands', to='shop.car')),
+            ],
+        ),
+    ]
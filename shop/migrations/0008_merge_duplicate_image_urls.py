@@ -0,0 +1,40 @@
+from django.db import migrations
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_image_urls(apps, schema_editor):
+    # Earlier crawls inserted every ad again on each run; keep the oldest row
+    # per image URL and point carts and reposts at it before deleting the rest.
+    Car = apps.get_model('shop', 'Car')
+    CartItem = apps.get_model('shop', 'CartItem')
+    db = schema_editor.connection.alias
+    duplicated = (
+        Car.objects.using(db).values('image_url')
+        .annotate(first_id=Min('id'), rows=Count('id')).filter(rows__gt=1)
+    )
+    for row in list(duplicated):
+        extra = Car.objects.using(db).filter(image_url=row['image_url']).exclude(id=row['first_id'])
+        # A cart may hold several of the copies; fold them into one item so
+        # (cart, product) stays unique for AddToCartView's get_or_create.
+        totals = (
+            CartItem.objects.using(db).filter(product__image_url=row['image_url'])
+            .values('cart_id').annotate(quantity=Sum('quantity'))
+        )
+        for total in list(totals):
+            CartItem.objects.using(db).update_or_create(
+                cart_id=total['cart_id'], product_id=row['first_id'], defaults={'quantity': total['quantity']},
+            )
+        CartItem.objects.using(db).filter(product__in=extra).delete()
+        Car.objects.using(db).filter(canonical__in=extra).exclude(id=row['first_id']).update(canonical_id=row['first_id'])
+        extra.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_carband'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_image_urls, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # Kept apart from 0008: on PostgreSQL the rows it deletes leave deferred
+    # foreign key checks pending, and ALTER TABLE refuses to run until they fire.
+    dependencies = [
+        ('shop', '0008_merge_duplicate_image_urls'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='car',
+            name='image_url',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
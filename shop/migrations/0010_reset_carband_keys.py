@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+def reset_carband_keys(apps, schema_editor):
+    # Price bands got wider, so the stored keys no longer match what lookups
+    # compute; the next dedup run re-indexes every canonical listing.
+    CarBand = apps.get_model('shop', 'CarBand')
+    CarBand.objects.using(schema_editor.connection.alias).all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_alter_car_image_url'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_carband_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_reset_carband_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pricesummary',
+            name='stale',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -5,16 +5,51 @@ class Car(models.Model):
 
     title = models.CharField(max_length=255)
     price = models.CharField(max_length=255)
-    image_url = models.CharField(max_length=255)
+    image_url = models.CharField(max_length=255, unique=True)
+    vehicle = models.CharField(max_length=100, blank=True, default='')
     # stock = models.IntegerField()
+    last_seen_at = models.DateTimeField(null=True, blank=True)
+    is_active = models.BooleanField(default=True)
+    canonical = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='duplicates')
 
     class Meta:
         managed = False  
         db_table = 'cars'  
+        indexes = [
+            # Catalogue queries only ever read live, canonical listings, so keep
+            # the index limited to them instead of every ad ever scraped.
+            models.Index(fields=['id'], condition=models.Q(is_active=True, canonical__isnull=True), name='cars_listed_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+class CarBand(models.Model):
+    # LSH band keys of canonical listings, persisted so each crawl only looks
+    # up its new listings instead of rebuilding the index over the catalogue.
+    car = models.ForeignKey(Car, on_delete=models.CASCADE, related_name='bands')
+    key = models.BigIntegerField(db_index=True)
+
+class PriceSummary(models.Model):
+    # Rolled up by the scraper after each crawl so the analytics endpoint
+    # never has to scan the cars table. ``vehicle`` is the slug the scraper
+    # searches by (e.g. "pride"), so one row covers all of its models.
+    vehicle = models.CharField(max_length=100, unique=True)
+    count = models.PositiveIntegerField()
+    min_price = models.BigIntegerField()
+    p25_price = models.BigIntegerField()
+    median_price = models.BigIntegerField()
+    p75_price = models.BigIntegerField()
+    max_price = models.BigIntegerField()
+    histogram = models.JSONField(default=list)
+    # Set by the scraper stages that change this vehicle's listings; only
+    # stale summaries are rolled up again.
+    stale = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Prices of {self.vehicle}"
+
 class Cart(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
 
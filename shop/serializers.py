@@ -1,7 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from django.contrib.auth.hashers import make_password
-from .models import Car, CartItem, Cart
+from .models import Car, CartItem, Cart, PriceSummary
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -21,6 +21,11 @@ class CarSerializer(serializers.ModelSerializer):
         model = Car
         fields = '__all__'  # This will include all fields in the JSON output
 
+class PriceSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PriceSummary
+        fields = ['vehicle', 'count', 'min_price', 'p25_price', 'median_price', 'p75_price', 'max_price', 'histogram', 'updated_at']
+
 class CartItemSerializer(serializers.ModelSerializer):
     product = CarSerializer()
 
@@ -1,38 +1,216 @@
 import asyncio
+import logging
+from urllib.parse import urlsplit
 import aiohttp
+from asgiref.sync import sync_to_async
 from bs4 import BeautifulSoup
-from django.db import transaction
-from .models import Car
+from django.conf import settings
+from django.db import close_old_connections, models, transaction
+from django.utils import timezone
+from .models import Car, CarBand, PriceSummary
+from .dedup import LSHIndex, fingerprint, index_keys, lookup_keys, price_band
+from .analytics import parse_price, summarize_prices
+from .fetch import FetchPolicy, UnexpectedPageError
 import json
+from datetime import timedelta
 
-async def fetch_page(session, url):
-    async with session.get(url) as response:
-        content_type = response.headers.get('Content-Type', '')
-        if 'application/json' in content_type:
-            return await response.json()
-        elif 'text/html' in content_type:
-            html_content = await response.text()
-            soup = BeautifulSoup(html_content, 'html.parser')
-            script_tag = soup.find('script', type='application/json')
-            if script_tag:
-                json_data = json.loads(script_tag.string)
-                return json_data
-            else:
-                return None
+logger = logging.getLogger(__name__)
+
+# Scraper writes go through their own alias so they get their own pool sizing.
+DB = 'scraper'
+VEHICLES = ['pride']
+SEARCH_URL = "https://bama.ir/cad/api/search?vehicle={vehicle}&pageIndex={page}"
+# Pages are requested this many at a time until one comes back without ads;
+# MAX_PAGES only guards against a source that never runs out.
+CONCURRENCY = 10
+MAX_PAGES = 500
+# Ads that slid across a page boundary mid-crawl are missed once and seen by
+# the next crawl, so they're only expired after going unseen this long.
+EXPIRY_GRACE = timedelta(days=1)
+DEDUP_BATCH_SIZE = 500
+
+def db_stage(func):
+    # Run on a worker thread with its own connection instead of queueing every
+    # page behind the single thread-sensitive one, and hand the connection back
+    # (to the pool, when pooling is on) once the stage is done.
+    def run(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False)
+
+async def parse_page(response):
+    content_type = response.headers.get('Content-Type', '')
+    if 'application/json' in content_type:
+        return await response.json()
+    elif 'text/html' in content_type:
+        html_content = await response.text()
+        soup = BeautifulSoup(html_content, 'html.parser')
+        script_tag = soup.find('script', type='application/json')
+        if script_tag:
+            json_data = json.loads(script_tag.string)
+            return json_data
+        else:
+            # Counting this page as empty would let the expiry sweep drop its ads.
+            raise UnexpectedPageError(f"No listing data in HTML from {response.url}")
+    else:
+        raise UnexpectedPageError(f"Unexpected Content-Type {content_type!r} from {response.url}")
+
+async def fetch_page(session, url, policy=None):
+    policy = policy or FetchPolicy()
+    host = urlsplit(url).netloc
+    for attempt in range(policy.retries + 1):
+        await policy.breaker.wait(host)
+        try:
+            async with session.get(url, timeout=policy.timeout) as response:
+                response.raise_for_status()
+                data = await parse_page(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnexpectedPageError) as exc:
+            if not policy.is_transient(exc):
+                # The host did answer, which also settles a probe.
+                policy.breaker.record_success(host)
+                raise
+            policy.breaker.record_failure(host)
+            # Once the breaker opens, leave probing the host to later pages.
+            if attempt == policy.retries or policy.breaker.is_open(host):
+                raise
+            delay = policy.delay(attempt)
+            logger.info("Retrying %s in %.1fs after %r", url, delay, exc)
+            await asyncio.sleep(delay)
+        else:
+            policy.breaker.record_success(host)
+            return data
+
+def mark_summaries_stale(vehicles):
+    PriceSummary.objects.using(DB).filter(vehicle__in=vehicles, stale=False).update(stale=True)
+
+@transaction.atomic(using=DB)
+def save_cars(cars, seen_at):
+    # Ads are identified by their image URL. Pages are saved concurrently and
+    # the same ad can show up on two of them, so this is a single upsert
+    # rather than check-then-insert; sorting takes row locks in one order so
+    # overlapping pages can't deadlock, and each ad may appear only once.
+    unique = {car['image_url']: car for car in cars}
+    existing = {
+        row[0]: row[1:] for row in Car.objects.using(DB).filter(image_url__in=unique).annotate(
+            indexed=models.Exists(CarBand.objects.filter(car=models.OuterRef('pk')))
+        ).values_list('image_url', 'id', 'title', 'price', 'vehicle', 'is_active', 'indexed')
+    }
+    # New ads and changes to price, vehicle or status alter a vehicle's rollup.
+    changed = set()
+    repriced = {}
+    for image_url, car in unique.items():
+        if image_url not in existing:
+            changed.add(car.get('vehicle', ''))
+            continue
+        car_id, title, price, vehicle, is_active, indexed = existing[image_url]
+        if (price, vehicle, is_active) != (car['price'], car.get('vehicle', ''), True):
+            changed.update([vehicle, car.get('vehicle', '')])
+        if indexed and price_band(parse_price(price)) != price_band(parse_price(car['price'])):
+            repriced[car_id] = fingerprint(title, car['price'])
+    Car.objects.db_manager(DB).bulk_create(
+        [Car(**car, last_seen_at=seen_at) for _, car in sorted(unique.items())],
+        update_conflicts=True,
+        unique_fields=['image_url'],
+        # vehicle too, so ads scraped before it was recorded get it once re-seen.
+        update_fields=['price', 'vehicle', 'last_seen_at', 'is_active'],
+    )
+    # Band keys are scoped by price band: re-key indexed listings whose price
+    # moved to another band, or reposts near the new price would miss them.
+    if repriced:
+        CarBand.objects.using(DB).filter(car_id__in=repriced).delete()
+        CarBand.objects.using(DB).bulk_create(
+            [CarBand(car_id=car_id, key=key) for car_id, fp in repriced.items() for key in index_keys(fp)]
+        )
+    mark_summaries_stale(changed)
+
+@transaction.atomic(using=DB)
+def expire_unseen_cars(seen_before):
+    # Set-based: anything not seen since the crawl started is gone from the source.
+    unseen = Car.objects.using(DB).filter(is_active=True).filter(
+        models.Q(last_seen_at__lt=seen_before) | models.Q(last_seen_at__isnull=True)
+    )
+    reposts = Car.objects.using(DB).filter(canonical__in=unseen)
+    mark_summaries_stale({
+        *unseen.values_list('vehicle', flat=True).distinct(), *reposts.values_list('vehicle', flat=True).distinct()
+    })
+    # Expired listings stop being dedup candidates, and their reposts get
+    # listed again (and re-deduped) instead of hiding behind them.
+    CarBand.objects.using(DB).filter(car__in=unseen).delete()
+    reposts.update(canonical=None)
+    return unseen.update(is_active=False)
+
+@transaction.atomic(using=DB)
+def dedup_batch(cars):
+    index = LSHIndex()
+    fingerprints = {car.id: fingerprint(car.title, car.price) for car in cars}
+    keys = {key for fp in fingerprints.values() for key in lookup_keys(fp)}
+    loaded = {}
+    for key, car_id, title, price in CarBand.objects.using(DB).filter(key__in=keys).values_list(
+        'key', 'car_id', 'car__title', 'car__price'
+    ):
+        if car_id not in loaded:
+            loaded[car_id] = fingerprint(title, price)
+        index.load(key, car_id, loaded[car_id])
+
+    bands = []
+    duplicates = []
+    for car in cars:
+        canonical_id = index.match(fingerprints[car.id])
+        if canonical_id is None:
+            bands += [CarBand(car=car, key=key) for key in index.add(car.id, fingerprints[car.id])]
+        else:
+            car.canonical_id = canonical_id
+            duplicates.append(car)
+    CarBand.objects.using(DB).bulk_create(bands)
+    Car.objects.db_manager(DB).bulk_update(duplicates, ['canonical'])
+    mark_summaries_stale({car.vehicle for car in duplicates})
+    return len(duplicates)
+
+def dedup_cars():
+    # Only listings that are neither indexed nor grouped yet (new ads, relisted
+    # ads, reposts whose canonical expired) are looked up, against the band
+    # keys persisted for the canonical listings.
+    pending = Car.objects.using(DB).filter(
+        is_active=True, canonical__isnull=True, bands__isnull=True
+    ).only('id', 'title', 'price', 'vehicle').order_by('id')
+    grouped = 0
+    last_id = 0
+    while True:
+        batch = list(pending.filter(id__gt=last_id)[:DEDUP_BATCH_SIZE])
+        if not batch:
+            break
+        last_id = batch[-1].id
+        grouped += dedup_batch(batch)
+    return grouped
+
+def refresh_price_summaries(vehicles):
+    # Only vehicles whose listings changed since their last rollup, or that
+    # have none yet, are scanned again, one vehicle at a time.
+    fresh = set(PriceSummary.objects.using(DB).filter(vehicle__in=vehicles, stale=False).values_list('vehicle', flat=True))
+    for vehicle in vehicles:
+        if vehicle in fresh:
+            continue
+        prices = Car.objects.using(DB).filter(
+            vehicle=vehicle, is_active=True, canonical__isnull=True
+        ).values_list('price', flat=True)
+        summary = summarize_prices(prices)
+        if summary is None:
+            PriceSummary.objects.using(DB).filter(vehicle=vehicle).delete()
         else:
-            return None
+            PriceSummary.objects.using(DB).update_or_create(vehicle=vehicle, defaults={**summary, 'stale': False})
 
-@transaction.atomic
-async def save_to_db(cars):
+async def save_to_db(cars, seen_at=None):
     if not cars:
         return
-    Car.objects.bulk_create([Car(**car) for car in cars])
+    await db_stage(save_cars)(cars, seen_at or timezone.now())
 
-async def scrape_page(session, url, semaphore):
+async def scrape_page(session, url, semaphore, seen_at=None, vehicle='', policy=None):
     async with semaphore:
-        data = await fetch_page(session, url)
+        data = await fetch_page(session, url, policy)
         if data is None:
-            return
+            return 0
 
         cars = []
         for ad in data.get('data', {}).get('ads', []):
@@ -48,19 +226,71 @@ async def scrape_page(session, url, semaphore):
                     car = {
                         'title': title,
                         'price': price,
-                        'image_url': image_url
+                        'image_url': image_url,
+                        'vehicle': vehicle,
                     }
                     cars.append(car)
         
-        await save_to_db(cars)
+        await save_to_db(cars, seen_at)
+        return len(cars)
+
+async def crawl_vehicle(session, vehicle, semaphore, seen_at, policy):
+    """Scrape the pages of one vehicle until the listing runs out.
+
+    Returns ``(seen, failed, complete)``; only a complete crawl has seen every
+    live ad, which the expiry sweep relies on.
+    """
+    seen = 0
+    failed = 0
+    for start in range(1, MAX_PAGES + 1, CONCURRENCY):
+        urls = [SEARCH_URL.format(vehicle=vehicle, page=page) for page in range(start, min(start + CONCURRENCY, MAX_PAGES + 1))]
+        # One bad page must not cancel the rest of the crawl.
+        results = await asyncio.gather(
+            *(scrape_page(session, url, semaphore, seen_at, vehicle, policy) for url in urls),
+            return_exceptions=True,
+        )
+        window_failed = 0
+        reached_end = False
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                window_failed += 1
+                logger.warning("Failed to scrape %s: %r", url, result)
+            elif result:
+                seen += result
+            else:
+                reached_end = True
+        failed += window_failed
+        if reached_end:
+            return seen, failed, True
+        if window_failed == len(urls):
+            logger.warning("Giving up on %s: every page from %d failed", vehicle, start)
+            return seen, failed, False
+    logger.warning("Stopped %s after %d pages without reaching the end", vehicle, MAX_PAGES)
+    return seen, failed, False
 
 async def main():
-    semaphore = asyncio.Semaphore(10)
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    crawl_started_at = timezone.now()
+    policy = FetchPolicy(**getattr(settings, 'SCRAPER_FETCH_POLICY', {}))
 
     async with aiohttp.ClientSession() as session:
-        tasks = []
+        results = await asyncio.gather(*(
+            crawl_vehicle(session, vehicle, semaphore, crawl_started_at, policy) for vehicle in VEHICLES
+        ))
 
-        for _ in range(1, 80):
-            url = f"https://bama.ir/cad/api/search?vehicle=pride&pageIndex={_}"
-            tasks.append(scrape_page(session, url, semaphore))
-        await asyncio.gather(*tasks)
+    seen = sum(result[0] for result in results)
+    failed = sum(result[1] for result in results)
+    complete = all(result[2] for result in results)
+
+    # Don't wipe the catalogue when the source returned nothing at all.
+    if not seen:
+        return
+    # Ads on pages we couldn't fetch, or past the last page we got to, may
+    # still be live, so only sweep after a clean crawl of every listing.
+    if failed or not complete:
+        logger.warning("Skipping expiry sweep: %d pages failed, listing %s", failed,
+                       'complete' if complete else 'incomplete')
+    else:
+        await db_stage(expire_unseen_cars)(crawl_started_at - EXPIRY_GRACE)
+    await db_stage(dedup_cars)()
+    await db_stage(refresh_price_summaries)(VEHICLES)
@@ -5,12 +5,27 @@ from rest_framework.test import APIClient
 from rest_framework import status
 from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
-from .models import Car, Cart, CartItem
+from .models import Car, CarBand, Cart, CartItem, PriceSummary
 import asyncio
 from unittest.mock import AsyncMock, patch
 from aioresponses import aioresponses
 import aiohttp
-from .tasks import fetch_page, scrape_page, save_to_db
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import time
+import os
+import subprocess
+import sys
+from .tasks import main, fetch_page, scrape_page, save_to_db, save_cars, expire_unseen_cars, dedup_cars, refresh_price_summaries
+from .analytics import summarize_prices
+from .fetch import CircuitOpenError, FetchPolicy, UnexpectedPageError
+from .dedup import group_duplicates
+from myproject.routers import replica_alias
+from datetime import timedelta
+from django.utils import timezone
+from django.conf import settings
+from django.db import IntegrityError, connections
+from django.test.utils import CaptureQueriesContext
 
 # ------------------------- Fixtures -------------------------
 
@@ -31,6 +46,20 @@ def authenticated_client(api_client, user):
 def car():
     return Car.objects.create(title='Test Car', price='10000', image_url='http://example.com/car.jpg')
 
+@pytest.fixture
+def scraper_db():
+    # Scraper stages write through the mirrored 'scraper' alias, so their tests
+    # commit for real, and the unmanaged cars table isn't flushed afterwards.
+    yield
+    Car.objects.all().delete()
+
+@pytest.fixture
+def replica_db(monkeypatch):
+    # The mirrored 'scraper' alias is a second connection to the test
+    # database, so it stands in for the replica.
+    monkeypatch.setattr('shop.views.replica_alias', lambda: 'scraper')
+    return connections['scraper']
+
 @pytest.fixture
 def cart(user):
     return Cart.objects.create(user=user)
@@ -89,6 +118,231 @@ def test_car_list_view(api_client, car):
     assert len(response.data) == 1
     assert response.data[0]['title'] == car.title
 
+# Test CarListView hides expired listings
+@pytest.mark.django_db
+def test_car_list_view_excludes_inactive(api_client, car):
+    Car.objects.create(title='Gone Car', price='5000', image_url='http://example.com/gone.jpg', is_active=False)
+    url = reverse('car-list')
+    response = api_client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    assert [c['title'] for c in response.data] == [car.title]
+
+# Test replica_alias only picks the replica when one is configured
+def test_replica_alias(monkeypatch):
+    assert replica_alias() == 'default'
+    monkeypatch.setitem(settings.DATABASES, 'replica', settings.DATABASES['default'])
+    assert replica_alias() == 'replica'
+
+# Test the catalogue reads from the replica while cart checks stay on the primary
+@pytest.mark.django_db(transaction=True, databases=['default', 'scraper'])
+def test_catalogue_reads_use_replica(replica_db, scraper_db, car):
+    user = User.objects.create_user(username='testuser', password='password')
+    client = APIClient()
+    client.force_authenticate(user=user)
+
+    with CaptureQueriesContext(replica_db) as replica_queries:
+        response = client.get(reverse('car-list'))
+    assert [c['id'] for c in response.data] == [car.id]
+    assert any('cars' in query['sql'] for query in replica_queries.captured_queries)
+
+    with CaptureQueriesContext(replica_db) as replica_queries:
+        response = client.post(reverse('add-to-cart', args=[car.id]))
+    assert response.status_code == 200
+    assert replica_queries.captured_queries == []
+
+# ------------------------- Expiry Tests -------------------------
+
+# Test save_cars bumps last_seen_at of known ads instead of duplicating them
+@pytest.mark.django_db(transaction=True, databases=['default', 'scraper'])
+def test_save_cars_marks_existing_seen(scraper_db, car):
+    seen_at = timezone.now()
+    save_cars([
+        {'title': car.title, 'price': car.price, 'image_url': car.image_url},
+        {'title': 'New Car', 'price': '20000', 'image_url': 'http://example.com/new.jpg'},
+    ], seen_at)
+    assert Car.objects.count() == 2
+    car.refresh_from_db()
+    assert car.last_seen_at == seen_at
+    assert Car.objects.get(title='New Car').last_seen_at == seen_at
+
+# Test save_cars upserts an ad seen on several pages into a single row
+@pytest.mark.django_db(transaction=True, databases=['default', 'scraper'])
+def test_save_cars_upserts_by_image_url(scraper_db):
+    ad = {'title': 'Test Car', 'price': '10000', 'image_url': 'http://example.com/car.jpg'}
+    save_cars([ad, ad], timezone.now())
+    save_cars([{**ad, 'price': '9000'}], timezone.now())
+    assert list(Car.objects.values_list('price', flat=True)) == ['9000']
+
+    with pytest.raises(IntegrityError):
+        Car.objects.create(**ad)
+
+# Test expire_unseen_cars deactivates only listings missing from the crawl
+@pytest.mark.django_db(transaction=True, databases=['default', 'scraper'])
+def test_expire_unseen_cars(scraper_db):
+    crawl_started_at = timezone.now()
+    stale = Car.objects.create(title='Stale', price='1', image_url='http://example.com/1.jpg',
+                               last_seen_at=crawl_started_at - timedelta(days=1))
+    never_seen = Car.objects.create(title='Legacy', price='2', image_url='http://example.com/2.jpg')
+    fresh = Car.objects.create(title='Fresh', price='3', image_url='http://example.com/3.jpg',
+                               last_seen_at=crawl_started_at)
+
+    assert expire_unseen_cars(crawl_started_at) == 2
+
+    assert not Car.objects.get(id=stale.id).is_active
+    assert not Car.objects.get(id=never_seen.id).is_active
+    assert Car.objects.get(id=fresh.id).is_active
+
+# ------------------------- Dedup Tests -------------------------
+
+DEDUP_LISTINGS = [
+    (1, 'Pride 131 SE 1398', '250,000,000'),
+    (2, 'pride 131 se - 1398!', '250000000'),
+    (3, 'Pride 131 SE 1398', '260,000,000'),
+    (4, 'Peugeot 206 Tip 2 1399', '250,000,000'),
+    (5, 'Pride 131 SE 1399', '250,000,000'),
+    (6, 'Pride 131 SE 1398 new', '250,000,000'),
+    (7, 'Pride 131 SE 1398', '150,000,000'),
+]
+
+# Test group_duplicates joins reposts and keeps distinct ads apart
+def test_group_duplicates():
+    groups = group_duplicates(DEDUP_LISTINGS)
+    assert groups == {1: 1, 2: 1, 3: 1, 4: 4, 5: 5, 6: 1, 7: 7}
+
+# Test reposts priced right at PRICE_TOLERANCE still find each other
+def test_group_duplicates_at_price_tolerance():
+    groups = group_duplicates([
+        (1, 'Pride 131 SE 1398', '2100748'),
+        (2, 'Pride 131 SE 1398', '1785636'),
+        (3, 'Peugeot 206 Tip 2 1399', '1000000'),
+        (4, 'Peugeot 206 Tip 2 1399', '850000'),
+        (5, 'Peugeot 206 Tip 2 1399', '849999'),
+    ])
+    assert groups == {1: 1, 2: 1, 3: 3, 4: 3, 5: 5}
+
+# Test group_duplicates gives the same groups in every process
+def test_group_duplicates_is_stable_across_processes():
+    script = f"from shop.dedup import group_duplicates; print(sorted(group_duplicates({DEDUP_LISTINGS!r}).items()))"
+    outputs = {
+        subprocess.run(
+            [sys.executable, '-c', script], cwd=os.path.dirname(os.path.dirname(__file__)), check=True, capture_output=True, text=True,
+            env={**os.environ, 'PYTHONHASHSEED': seed},
+        ).stdout
+        for seed in ('1', '2')
+    }
+    assert len(outputs) == 1
+
+# Test dedup_cars hides reposts from CarListView
+@pytest.mark.django_db(transaction=True, databases=['default', 'scraper'])
+def test_dedup_cars(scraper_db, api_client, car):
+    repost = Car.objects.create(title='Test Car!', price='10000', image_url='http://example.com/car2.jpg')
+
+    assert dedup_cars() == 1
+
+    repost.refresh_from_db()
+    assert repost.canonical_id == car.id
+    response = api_client.get(reverse('car-list'))
+    assert [c['id'] for c in response.data] == [car.id]
+
+# Test dedup_cars only looks up new listings against persisted band keys
+@pytest.mark.django_db(transaction=True, databases=['default', 'scraper'])
+def test_dedup_cars_is_incremental(scraper_db, car):
+    assert dedup_cars() == 0
+    assert CarBand.objects.filter(car=car).count() > 0
+    assert dedup_cars() == 0
+
+    # A repost with a price cut is grouped under the already indexed listing.
+    repost = Car.objects.create(title='Test Car', price='9500', image_url='http://example.com/car2.jpg')
+    assert dedup_cars() == 1
+    repost.refresh_from_db()
+    assert repost.canonical_id == car.id
+    assert not CarBand.objects.filter(car=repost).exists()
+
+    # Once the canonical listing expires, the repost takes its place.
+    expire_unseen_cars(timezone.now())
+    Car.objects.filter(id=repost.id).update(is_active=True)
+    repost.refresh_from_db()
+    assert repost.canonical_id is None
+    assert not CarBand.objects.filter(car=car).exists()
+    assert dedup_cars() == 0
+    assert CarBand.objects.filter(car=repost).exists()
+
+# Test a price cut re-keys an indexed listing so reposts at the new price find it
+@pytest.mark.django_db(transaction=True, databases=['default', 'scraper'])
+def test_save_cars_rekeys_repriced_listings(scraper_db, car):
+    dedup_cars()
+    keys = set(CarBand.objects.filter(car=car).values_list('key', flat=True))
+
+    save_cars([{'title': car.title, 'price': '5000', 'image_url': car.image_url}], timezone.now())
+
+    assert set(CarBand.objects.filter(car=car).values_list('key', flat=True)).isdisjoint(keys)
+    repost = Car.objects.create(title='Test Car', price='4800', image_url='http://example.com/car2.jpg')
+    assert dedup_cars() == 1
+    repost.refresh_from_db()
+    assert repost.canonical_id == car.id
+
+# ------------------------- Price Analytics Tests -------------------------
+
+# Test summarize_prices skips non-numeric prices and buckets the rest
+def test_summarize_prices():
+    summary = summarize_prices(['100', '200', '300', '400', '1,000', 'negotiable'])
+    assert summary['count'] == 5
+    assert (summary['min_price'], summary['median_price'], summary['max_price']) == (100, 300, 1000)
+    assert summary['p25_price'] == 200
+    assert sum(bucket['count'] for bucket in summary['histogram']) == 5
+    assert summarize_prices(['negotiable']) is None
+
+# Test refresh_price_summaries rolls up live listings per vehicle
+@pytest.mark.django_db(transaction=True, databases=['default', 'scraper'])
+def test_refresh_price_summaries(scraper_db, api_client):
+    Car.objects.create(title='A', price='100', image_url='a.jpg', vehicle='pride')
+    Car.objects.create(title='B', price='300', image_url='b.jpg', vehicle='pride')
+    Car.objects.create(title='C', price='900', image_url='c.jpg', vehicle='pride', is_active=False)
+
+    refresh_price_summaries(['pride', 'tiba'])
+
+    assert not PriceSummary.objects.filter(vehicle='tiba').exists()
+    response = api_client.get(reverse('price-summary-list'), {'vehicle': 'pride'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data[0]['count'] == 2
+    assert response.data[0]['median_price'] == 200
+    assert response.data[0]['max_price'] == 300
+
+# Test ads scraped before vehicles were recorded count once they're re-seen
+@pytest.mark.django_db(transaction=True, databases=['default', 'scraper'])
+def test_refresh_price_summaries_counts_reseen_legacy_cars(scraper_db, car):
+    assert car.vehicle == ''
+    save_cars([{'title': car.title, 'price': car.price, 'image_url': car.image_url, 'vehicle': 'pride'}],
+              timezone.now())
+
+    refresh_price_summaries(['pride'])
+
+    car.refresh_from_db()
+    assert car.vehicle == 'pride'
+    assert PriceSummary.objects.get(vehicle='pride').count == 1
+
+# Test only vehicles whose listings changed are rolled up again
+@pytest.mark.django_db(transaction=True, databases=['default', 'scraper'])
+def test_refresh_price_summaries_skips_unchanged_vehicles(scraper_db):
+    ad = {'title': 'A', 'price': '100', 'image_url': 'a.jpg', 'vehicle': 'pride'}
+    save_cars([ad, {**ad, 'image_url': 'b.jpg', 'vehicle': 'tiba'}], timezone.now())
+    refresh_price_summaries(['pride', 'tiba'])
+    assert not PriceSummary.objects.filter(stale=True).exists()
+
+    save_cars([ad], timezone.now())
+    assert not PriceSummary.objects.filter(stale=True).exists()
+    with CaptureQueriesContext(connections['scraper']) as queries:
+        refresh_price_summaries(['pride', 'tiba'])
+    assert len(queries) == 1
+
+    save_cars([{**ad, 'price': '300'}], timezone.now())
+    assert list(PriceSummary.objects.filter(stale=True).values_list('vehicle', flat=True)) == ['pride']
+    refresh_price_summaries(['pride', 'tiba'])
+    assert PriceSummary.objects.get(vehicle='pride').max_price == 300
+
+    expire_unseen_cars(timezone.now())
+    assert PriceSummary.objects.filter(stale=True).count() == 2
+
 # ------------------------- Cart Tests -------------------------
 
 # Test AddToCartView
@@ -114,11 +368,26 @@ def test_add_to_cart_invalid_car():
     client = APIClient()
     client.force_authenticate(user=user)
 
-    url = reverse('add-to-cart', args=[999])  
+    url = reverse('add-to-cart', args=[999])
     response = client.post(url, {})
 
     assert response.status_code == 404
 
+# Test expired car in AddToCartView
+@pytest.mark.django_db
+def test_add_to_cart_inactive_car():
+    user = User.objects.create_user(username='testuser', password='password')
+    car = Car.objects.create(title='Test Car', price='10000', image_url='http://example.com/car.jpg', is_active=False)
+
+    client = APIClient()
+    client.force_authenticate(user=user)
+
+    url = reverse('add-to-cart', args=[car.id])
+    response = client.post(url, {})
+
+    assert response.status_code == 404
+    assert not CartItem.objects.filter(cart__user=user).exists()
+
 # Test CartDetailView
 @pytest.mark.django_db
 def test_cart_detail_view():
@@ -160,6 +429,11 @@ def test_update_cart_item_view():
     response = client.post(url, {'quantity': 'invalid'})
     assert response.status_code == 400
 
+    # Test that an expired car can no longer be bumped
+    Car.objects.filter(id=car.id).update(is_active=False)
+    response = client.post(url, {'quantity': 3})
+    assert response.status_code == 409
+
 # ------------------------- Checkout Tests -------------------------
 
 # Test CheckoutView
@@ -179,6 +453,24 @@ def test_checkout_view():
     assert response.status_code == 200
     assert not CartItem.objects.filter(cart=cart).exists()
 
+# Test CheckoutView reports expired items
+@pytest.mark.django_db
+def test_checkout_reports_expired_items():
+    user = User.objects.create_user(username='testuser', password='password')
+    car = Car.objects.create(title='Test Car', price='10000', image_url='http://example.com/car.jpg', is_active=False)
+    cart = Cart.objects.create(user=user)
+    cart_item = CartItem.objects.create(cart=cart, product=car, quantity=1)
+
+    client = APIClient()
+    client.force_authenticate(user=user)
+
+    url = reverse('checkout')
+    response = client.post(url)
+
+    assert response.status_code == 200
+    assert response.data['expired_items'] == [cart_item.id]
+    assert not CartItem.objects.filter(cart=cart).exists()
+
 # Test CheckoutView with an empty cart
 @pytest.mark.django_db
 def test_checkout_empty_cart():
@@ -192,3 +484,185 @@ def test_checkout_empty_cart():
     response = client.post(url)
     
     assert response.status_code == 200
+
+# ------------------------- Fetch Policy Tests -------------------------
+
+def fetch_from(handler, policy):
+    # Serve handler from a local aiohttp server and fetch it once through fetch_page.
+    async def run():
+        app = web.Application()
+        app.router.add_get('/page', handler)
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            return await fetch_page(session, str(server.make_url('/page')), policy)
+    return asyncio.run(run())
+
+def flaky_handler(failures, status=503, delay=0):
+    calls = []
+    async def handler(request):
+        calls.append(request)
+        if len(calls) <= failures:
+            await asyncio.sleep(delay)
+            return web.Response(status=status)
+        return web.json_response({'data': {'ads': []}})
+    return handler, calls
+
+# Test fetch_page retries transient server errors
+def test_fetch_page_retries_transient_errors():
+    handler, calls = flaky_handler(failures=2)
+    data = fetch_from(handler, FetchPolicy(retries=3, backoff=0))
+    assert data == {'data': {'ads': []}}
+    assert len(calls) == 3
+
+# Test fetch_page gives up after the last retry
+def test_fetch_page_raises_after_retries():
+    handler, calls = flaky_handler(failures=10)
+    with pytest.raises(aiohttp.ClientResponseError):
+        fetch_from(handler, FetchPolicy(retries=2, backoff=0))
+    assert len(calls) == 3
+
+# Test fetch_page doesn't retry client errors
+def test_fetch_page_does_not_retry_not_found():
+    handler, calls = flaky_handler(failures=10, status=404)
+    with pytest.raises(aiohttp.ClientResponseError):
+        fetch_from(handler, FetchPolicy(retries=3, backoff=0))
+    assert len(calls) == 1
+
+# Test fetch_page times out slow responses and retries them
+def test_fetch_page_read_timeout():
+    handler, calls = flaky_handler(failures=1, status=200, delay=1)
+    data = fetch_from(handler, FetchPolicy(total=0.3, read=0.2, retries=1, backoff=0))
+    assert data == {'data': {'ads': []}}
+    assert len(calls) == 2
+
+# Test fetch_page stops retrying once the circuit breaker opens
+def test_fetch_page_stops_retrying_when_circuit_opens():
+    handler, calls = flaky_handler(failures=10)
+    with pytest.raises(aiohttp.ClientResponseError):
+        fetch_from(handler, FetchPolicy(retries=5, backoff=0, breaker_threshold=2))
+    assert len(calls) == 2
+
+# Test an open circuit fails fast except for one probe that waits out the cooldown
+def test_fetch_page_circuit_breaker_fails_fast_while_open():
+    handler, calls = flaky_handler(failures=1)
+    policy = FetchPolicy(retries=0, breaker_threshold=1, breaker_cooldown=0.3)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/page', handler)
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            url = str(server.make_url('/page'))
+            with pytest.raises(aiohttp.ClientResponseError):
+                await fetch_page(session, url, policy)
+            started = time.monotonic()
+            results = await asyncio.gather(*(fetch_page(session, url, policy) for _ in range(3)), return_exceptions=True)
+            return time.monotonic() - started, results
+
+    elapsed, results = asyncio.run(run())
+    assert elapsed >= 0.3
+    assert results[0] == {'data': {'ads': []}}
+    assert all(isinstance(result, CircuitOpenError) for result in results[1:])
+    assert len(calls) == 2
+
+def listing_of(pages, failing=()):
+    # Fake scrape_page for a listing with one ad on each of its pages.
+    scraped = []
+    async def scrape(session, url, *args):
+        page = int(url.rsplit('=', 1)[1])
+        scraped.append(page)
+        if page in failing:
+            raise aiohttp.ClientConnectionError()
+        return 1 if page <= pages else 0
+    return scrape, scraped
+
+def run_main(scrape):
+    with patch('shop.tasks.scrape_page', side_effect=scrape), \
+            patch('shop.tasks.expire_unseen_cars') as expire, \
+            patch('shop.tasks.dedup_cars') as dedup, \
+            patch('shop.tasks.refresh_price_summaries') as refresh:
+        asyncio.run(main())
+    return expire, dedup, refresh
+
+# Test one failing page doesn't abort the crawl or expire its ads
+def test_main_isolates_failed_pages():
+    scrape, scraped = listing_of(pages=25, failing={1})
+    expire, dedup, refresh = run_main(scrape)
+
+    assert max(scraped) == 30
+    expire.assert_not_called()
+    dedup.assert_called_once()
+    refresh.assert_called_once()
+
+# Test main pages past the old fixed limit and sweeps once the listing runs out
+def test_main_paginates_until_listing_ends():
+    scrape, scraped = listing_of(pages=95)
+    expire, dedup, refresh = run_main(scrape)
+
+    assert sorted(scraped) == list(range(1, 101))
+    expire.assert_called_once()
+
+# Test main doesn't sweep when it stopped before the end of the listing
+def test_main_skips_sweep_when_listing_not_exhausted():
+    scrape, scraped = listing_of(pages=100)
+    with patch('shop.tasks.MAX_PAGES', 50):
+        expire, dedup, refresh = run_main(scrape)
+
+    assert max(scraped) == 50
+    expire.assert_not_called()
+    dedup.assert_called_once()
+
+# Test fetch_page treats a page without listing data as a failure
+def test_fetch_page_rejects_page_without_listings():
+    async def handler(request):
+        return web.Response(text='<html>captcha</html>', content_type='text/html')
+    with pytest.raises(UnexpectedPageError):
+        fetch_from(handler, FetchPolicy(retries=0))
+
+# Test a captcha page counts as failed, so its ads aren't swept as unseen
+def test_main_counts_unparseable_pages_as_failed(monkeypatch):
+    monkeypatch.setattr(settings, 'SCRAPER_FETCH_POLICY', {'retries': 0})
+    ads = {'data': {'ads': [{'detail': {'title': 'Test Car', 'image': 'car.jpg'}, 'price': {'price': '10000'}}]}}
+
+    async def handler(request):
+        page = int(request.query['pageIndex'])
+        if page == 1:
+            return web.Response(text='<html>captcha</html>', content_type='text/html')
+        return web.json_response(ads if page <= 20 else {'data': {'ads': []}})
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/search', handler)
+        async with TestServer(app) as server:
+            url = str(server.make_url('/search')) + '?vehicle={vehicle}&pageIndex={page}'
+            with patch('shop.tasks.SEARCH_URL', url):
+                await main()
+
+    with patch('shop.tasks.save_to_db', new_callable=AsyncMock) as save, \
+            patch('shop.tasks.expire_unseen_cars') as expire, \
+            patch('shop.tasks.dedup_cars'), \
+            patch('shop.tasks.refresh_price_summaries'):
+        asyncio.run(run())
+
+    assert save.await_count == 29
+    expire.assert_not_called()
+
+# Test a dead host fails the crawl at once instead of waiting out cooldowns
+def test_main_gives_up_quickly_on_dead_host(monkeypatch):
+    monkeypatch.setattr(settings, 'SCRAPER_FETCH_POLICY', {'backoff': 0, 'breaker_cooldown': 0.5})
+    handler, calls = flaky_handler(failures=10_000)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/search', handler)
+        async with TestServer(app) as server:
+            url = str(server.make_url('/search')) + '?vehicle={vehicle}&pageIndex={page}'
+            with patch('shop.tasks.SEARCH_URL', url):
+                await main()
+
+    started = time.monotonic()
+    with patch('shop.tasks.expire_unseen_cars') as expire:
+        asyncio.run(run())
+
+    # One window of pages, plus at most a single probe after the cooldown.
+    assert time.monotonic() - started < 5
+    assert len(calls) <= 11
+    expire.assert_not_called()
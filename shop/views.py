@@ -3,12 +3,13 @@ from rest_framework.authtoken.models import Token
 from rest_framework import generics, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from .models import Car, Cart, CartItem
-from .serializers import CarSerializer, CartSerializer, UserSerializer
+from .models import Car, Cart, CartItem, PriceSummary
+from .serializers import CarSerializer, CartSerializer, PriceSummarySerializer, UserSerializer
 from django.shortcuts import get_object_or_404
 from rest_framework.throttling import ScopedRateThrottle
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
+from myproject.routers import replica_alias
 
 class UserCreate(APIView):
     @swagger_auto_schema(
@@ -61,9 +62,11 @@ class UserLogout(APIView):
         return Response(status=status.HTTP_200_OK)
     
 class CarListView(generics.ListAPIView):
-    queryset = Car.objects.all()
     serializer_class = CarSerializer
 
+    def get_queryset(self):
+        return Car.objects.using(replica_alias()).filter(is_active=True, canonical__isnull=True)
+
     @swagger_auto_schema(
         operation_description="Retrieve a list of available cars",
         responses={200: CarSerializer(many=True)}
@@ -71,13 +74,34 @@ class CarListView(generics.ListAPIView):
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
+class PriceSummaryListView(generics.ListAPIView):
+    serializer_class = PriceSummarySerializer
+
+    def get_queryset(self):
+        queryset = PriceSummary.objects.using(replica_alias()).order_by('vehicle')
+        vehicle = self.request.query_params.get('vehicle')
+        if vehicle:
+            queryset = queryset.filter(vehicle=vehicle)
+        return queryset
+
+    @swagger_auto_schema(
+        operation_description="Retrieve precomputed price statistics per vehicle. A vehicle is the slug the "
+                              "scraper searches by (e.g. pride), so its statistics cover all of its models.",
+        manual_parameters=[
+            openapi.Parameter('vehicle', openapi.IN_QUERY, type=openapi.TYPE_STRING, description='Only this vehicle slug'),
+        ],
+        responses={200: PriceSummarySerializer(many=True)}
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
 class AddToCartView(APIView):
     @swagger_auto_schema(
         operation_description="Add a car to the user's cart",
         responses={200: 'Added to cart', 404: 'Car not found'}
     )
     def post(self, request, car_id):
-        car = get_object_or_404(Car, id=car_id)
+        car = get_object_or_404(Car, id=car_id, is_active=True)
         cart, _ = Cart.objects.get_or_create(user=request.user)
         cart_item, created = CartItem.objects.get_or_create(cart=cart, product=car)
         if not created:
@@ -105,7 +129,7 @@ class UpdateCartItemView(APIView):
             },
             required=['quantity'],
         ),
-        responses={200: 'Cart updated', 400: 'Invalid quantity', 404: 'Item not found'}
+        responses={200: 'Cart updated', 400: 'Invalid quantity', 404: 'Item not found', 409: 'Car no longer available'}
     )
     def post(self, request, item_id):
         cart_item = get_object_or_404(CartItem, id=item_id)
@@ -115,6 +139,9 @@ class UpdateCartItemView(APIView):
         except ValueError:
             return Response({'error': 'Invalid quantity'}, status=status.HTTP_400_BAD_REQUEST)
         
+        if quantity > 0 and not cart_item.product.is_active:
+            return Response({'error': 'Car no longer available'}, status=status.HTTP_409_CONFLICT)
+
         if quantity <= 0:
             cart_item.delete()
         else:
@@ -130,5 +157,7 @@ class CheckoutView(APIView):
     )
     def post(self, request):
         cart = get_object_or_404(Cart, user=request.user)
+        # Expired listings can't be bought; drop them and tell the client which ones.
+        expired = list(cart.items.filter(product__is_active=False).values_list('id', flat=True))
         cart.items.all().delete()  
-        return Response({'status': 'Checkout successful'}, status=status.HTTP_200_OK)
+        return Response({'status': 'Checkout successful', 'expired_items': expired}, status=status.HTTP_200_OK)